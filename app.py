@@ -1,28 +1,124 @@
-from flask import Flask, jsonify, send_file
+from flask import Flask, Response, jsonify, request, send_file
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import desc
-from datetime import datetime
-from typing import List, Literal, Tuple, TypedDict, Union
+from sqlalchemy import (
+    Column,
+    ColumnDefault,
+    Engine,
+    Row,
+    case,
+    delete,
+    desc,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.ext.hybrid import hybrid_property
+from datetime import datetime, timedelta
+from datetime import time as time_of_day
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby, islice
+from operator import attrgetter, itemgetter
+from typing import (
+    Any,
+    Dict,
+    IO,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Sequence,
+    TextIO,
+    Tuple,
+    TypedDict,
+    Union,
+    cast,
+    overload,
+)
 from threading import Thread
+import os
 import random
+import shutil
+import sqlite3
 import string
 import csv
+import gzip
+import hashlib
+import logging
 import pytz
 import time
 
 ## FLASK APP
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///loop_app.db"
+# a connection pool shared by the request threads and the report threads, so that
+# concurrent reports don't wait on (or reconnect for) a single connection. With
+# WAL enabled on every sqlite connection, readers don't block each other
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_pre_ping": True,
+}
+# when served behind nginx, the location the reports directory is aliased to
+# (e.g. "/protected/"), so that nginx sends the report files instead of flask
+app.config["REPORTS_ACCEL_REDIRECT"] = None
+
+## LOGGING
+# debug messages are only formatted when the level is enabled (WARNING by default)
+logger = logging.getLogger(__name__)
 
 ## DATABASE
 db = SQLAlchemy()
 db.init_app(app)
 
+
+# tune every new sqlite connection for the read heavy report queries: WAL so that
+# readers don't block on writers, and a larger page cache and memory map
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+# restore the sync setting of a sqlite connection that a bulk load turned off, as
+# it is returned to the pool: the transaction is over by then (the setting can't
+# be changed inside one), and no other thread can have checked it out yet
+@event.listens_for(Engine, "checkin")
+def restore_sqlite_synchronous(dbapi_connection, connection_record):
+    if connection_record.info.pop("synchronous_off", False) and isinstance(
+        dbapi_connection, sqlite3.Connection
+    ):
+        dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+
+
 # GLOBALS
 time_format = "%H:%M:%S"
-timestamp_format = "%Y-%m-%d %H:%M:%S.%f %Z"
+seconds_in_day = 24 * 60 * 60
+minutes_in_day = 24 * 60
+minutes_in_week = 7 * minutes_in_day
+# timezones change their UTC offset at multiples of 15 minutes (UTC)
+offset_slot = 15 * 60
+# how far back from the last poll to fetch polls (one day beyond the week,
+# so that the end of the week can be detected)
+status_window = timedelta(days=8)
+# Assumption: If no business hours are found, assume the store to be open 24*7
+all_day_hours = [(0, seconds_in_day - 1)]
+# Assumption: If no timezone is found, assume the store to be in America/Chicago
+default_timezone = "America/Chicago"
 WeekdayType = Literal[0, 1, 2, 3, 4, 5, 6]
 StatusType = Literal["active", "inactive"]
+# a store's business hours on every weekday, as sorted (start, end) seconds of the day
+StoreHoursType = Dict[int, List[Tuple[int, int]]]
+# a poll, as its local time (seconds since the unix epoch) and status (1 if active)
+PollType = Tuple[int, int]
 
 
 ## MODELS
@@ -30,17 +126,47 @@ StatusType = Literal["active", "inactive"]
 class StoreHours(db.Model):
     id: int = db.Column(db.Integer, primary_key=True)
     store_id: str = db.Column(db.String)
-    day_of_week: WeekdayType = db.Column(db.Integer)
-    start_time: datetime = db.Column(db.DateTime)
-    end_time: datetime = db.Column(db.DateTime)
+    day_of_week: WeekdayType = db.Column(db.SmallInteger)
+    start_time: time_of_day = db.Column(db.Time)
+    end_time: time_of_day = db.Column(db.Time)
+
+
+# business hours are always read per store
+db.Index("ix_hours_store_dow", StoreHours.store_id, StoreHours.day_of_week)
 
 
 # store status model (whether the store is active or inactive)
 class StoreStatus(db.Model):
     id: int = db.Column(db.Integer, primary_key=True)
     store_id: str = db.Column(db.String)
-    status: StatusType = db.Column(db.String)
+    # 1 if the store was active, 0 if it was inactive
+    status: int = db.Column(db.SmallInteger)
     timestamp: datetime = db.Column(db.DateTime)
+    # timestamp as seconds since the unix epoch (UTC), computed when loading the data
+    ts_epoch: int = db.Column(db.BigInteger)
+    # local time (in the store's timezone) of the timestamp, as seconds since the
+    # unix epoch, computed when loading the data
+    local_epoch: int = db.Column(db.BigInteger)
+
+    # status as "active" or "inactive"
+    @hybrid_property
+    def status_name(self) -> StatusType:
+        return "active" if self.status else "inactive"
+
+    @status_name.inplace.expression
+    @classmethod
+    def _status_name_expression(cls):
+        return case((cls.status == 1, "active"), else_="inactive")
+
+
+# polls are always read per store by local time, latest first. The status is
+# included so that the polls are read from the index alone
+db.Index(
+    "ix_status_store_local",
+    StoreStatus.store_id,
+    StoreStatus.local_epoch.desc(),
+    StoreStatus.status,
+)
 
 
 # timezone model (store's local timezone)
@@ -50,98 +176,240 @@ class Timezone(db.Model):
     timezone: str = db.Column(db.String)
 
 
+# a store has a single timezone, looked up by store
+db.Index("ix_tz_store", Timezone.store_id, unique=True)
+
+
+# daily uptime model (a store's up and down time within business hours, per
+# local day), rolled up from the polls by the rollup-uptime command
+class StoreUptimeDaily(db.Model):
+    id: int = db.Column(db.Integer, primary_key=True)
+    store_id: str = db.Column(db.String)
+    # local date, as days since the unix epoch
+    day: int = db.Column(db.Integer)
+    up_hours: int = db.Column(db.Integer)
+    down_hours: int = db.Column(db.Integer)
+
+
+db.Index("ix_uptime_store_day", StoreUptimeDaily.store_id, StoreUptimeDaily.day)
+
+
+# precomputed report model (a store's up and down times, as written to the
+# reports), computed in the background after every data load
+class StoreReport(db.Model):
+    store_id: str = db.Column(db.String, primary_key=True)
+    up_hourly: int = db.Column(db.Integer)  # in minutes
+    up_daily: int = db.Column(db.Integer)  # in hours
+    up_weekly: int = db.Column(db.Integer)  # in hours
+    down_hourly: int = db.Column(db.Integer)  # in minutes
+    down_daily: int = db.Column(db.Integer)  # in hours
+    down_weekly: int = db.Column(db.Integer)  # in hours
+    # fingerprint of the data the times were computed from
+    fingerprint: str = db.Column(db.String)
+
+
 # reports model for keeping track of reports
 class Report(db.Model):
     report_id: str = db.Column(db.String, primary_key=True)
     status: Literal["Running", "Completed"] = db.Column(db.String, default="Running")
     # time taken to generate the report (in minutes)
     time_taken: float = db.Column(db.Float)
+    # fingerprint of the data the report was generated from
+    fingerprint: str = db.Column(db.String, index=True)
 
 
 ## HELPERS
-# get the operating business hours of a store on a particular weekday
-def get_store_time(store_id: str, day_of_week: int) -> List[Tuple[datetime, datetime]]:
-    store_data: List[StoreHours] = (
-        StoreHours.query.filter(
-            (StoreHours.store_id == store_id) & (StoreHours.day_of_week == day_of_week)
-        )
-        .order_by("start_time", "end_time")
-        .all()
-    )
-
-    times = []
+# group business hours rows (day_of_week, start_time, end_time) by weekday, as
+# seconds of the day (store_data is expected to be ordered by start_time, end_time)
+# overlapping ranges are merged, so that the ranges of a weekday are disjoint
+def group_store_hours(store_data: Sequence[Row]) -> StoreHoursType:
+    times: StoreHoursType = {}
     for store in store_data:
-        times.append((store.start_time, store.end_time))
+        start, end = get_seconds(store.start_time), get_seconds(store.end_time)
+        hours = times.setdefault(store.day_of_week, [])
+        # a range that ends before it starts never contains a poll
+        if end < start:
+            continue
 
-    # Assumption: If no data was found, assume the store to be open 24*7
-    if not times:
-        times.append((datetime(1900, 1, 1, 0, 0, 0), datetime(1900, 1, 1, 23, 59, 59)))
+        if hours and start <= hours[-1][1] + 1:
+            hours[-1] = (hours[-1][0], max(hours[-1][1], end))
+        else:
+            hours.append((start, end))
 
     return times
 
 
-# convert a formatted string to a datetime object
-def get_datetime_from_ts(timestamp: str, only_time=False):
+# get the operating business hours of every store, loaded in a single query
+# (cached, since the hours table is small and is read for every store)
+@lru_cache(maxsize=1)
+def get_hours_of_all_stores() -> Dict[str, StoreHoursType]:
+    store_data = db.session.execute(
+        select(
+            StoreHours.store_id,
+            StoreHours.day_of_week,
+            StoreHours.start_time,
+            StoreHours.end_time,
+        ).order_by(StoreHours.store_id, StoreHours.start_time, StoreHours.end_time)
+    ).all()
+
+    return {
+        store_id: group_store_hours(list(hours))
+        for store_id, hours in groupby(store_data, key=attrgetter("store_id"))
+    }
+
+
+# get the operating business hours of a store for every weekday
+def get_all_store_hours(store_id: str) -> StoreHoursType:
+    return get_hours_of_all_stores().get(store_id, {})
+
+
+# get the operating business hours of many stores at once
+def get_stores_hours(store_ids: List[str]) -> Dict[str, StoreHoursType]:
+    return {store_id: get_all_store_hours(store_id) for store_id in store_ids}
+
+
+# convert a formatted string to a datetime object, or a time object if only_time
+# (fromisoformat is implemented in C, and is much faster than strptime)
+@overload
+def get_datetime_from_ts(
+    timestamp: str, only_time: Literal[False] = False
+) -> datetime: ...
+@overload
+def get_datetime_from_ts(timestamp: str, only_time: Literal[True]) -> time_of_day: ...
+def get_datetime_from_ts(
+    timestamp: str, only_time=False
+) -> Union[datetime, time_of_day]:
     # time format: 12:24:54
     if only_time:
-        return datetime.strptime(timestamp, time_format)
+        try:
+            return time_of_day.fromisoformat(timestamp)
+        except ValueError:
+            # if the hour isn't zero padded
+            return datetime.strptime(timestamp, time_format).time()
 
-    # timestamp format: 2023-01-25 11:09:27.334577 UTC
+    # timestamp format: 2023-01-25 11:09:27.334577 UTC (naive, in UTC)
     try:
-        return datetime.strptime(timestamp, timestamp_format)
+        return datetime.fromisoformat(timestamp[:-4])
     except ValueError:
-        # if timestamp has no milliseconds part
-        return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S %Z")
+        # if the milliseconds part doesn't have 3 or 6 digits (before python 3.11),
+        # slice the fixed format instead
+        microsecond = timestamp[20:-4]
+        return datetime(
+            int(timestamp[0:4]),
+            int(timestamp[5:7]),
+            int(timestamp[8:10]),
+            int(timestamp[11:13]),
+            int(timestamp[14:16]),
+            int(timestamp[17:19]),
+            int(microsecond.ljust(6, "0")) if microsecond else 0,
+        )
 
 
-# get local timezone of a store
-def get_local_tz(store_id: str):
-    local_tz = Timezone.query.filter(Timezone.store_id == store_id).first().timezone
-    local_tz = pytz.timezone(local_tz)
-    return local_tz
+# convert a time of the day to seconds since midnight
+def get_seconds(day_time: time_of_day) -> int:
+    return day_time.hour * 3600 + day_time.minute * 60 + day_time.second
 
 
-# type class for typing the return type of the following function
-class InitialVars(TypedDict):
-    local_tz: pytz.BaseTzInfo
-    last_day_ts: datetime
-    business_hours: List[Tuple[datetime, datetime]]
-    store_status: List[StoreStatus]
+# get a store's business hours indexed by weekday, filling in missing weekdays
+def get_hours_by_weekday(store_hours: StoreHoursType) -> List[List[Tuple[int, int]]]:
+    return [store_hours.get(weekday, all_day_hours) for weekday in range(7)]
 
 
-# helper function to initialise the getters below
-def get_initial_vars(store_id: str) -> Union[InitialVars, None]:
-    # get timestamps in descending order to get the last day records
-    store_status: List[StoreStatus] = (
-        StoreStatus.query.filter((StoreStatus.store_id == store_id))
-        .order_by(desc("timestamp"))
-        .all()
-    )
+# get a store's business hours as a bitmap of the minutes of the week, bit
+# (weekday * minutes_in_day + minute of the day) is set if the store is open
+def get_hours_bitmap(store_hours: StoreHoursType) -> bytes:
+    bitmap = 0
+    for weekday, hours in enumerate(get_hours_by_weekday(store_hours)):
+        for start, end in hours:
+            first = weekday * minutes_in_day + start // 60
+            last = weekday * minutes_in_day + end // 60
+            bitmap |= ((1 << (last - first + 1)) - 1) << first
 
-    # if no polls are available for a store, return None
-    if not store_status:
-        return None
+    return bitmap.to_bytes(minutes_in_week // 8, "little")
 
-    # first entry is the last day, last time in UTC
-    local_tz = get_local_tz(store_id)
-    last_day_ts = store_status[0].timestamp.astimezone(local_tz)
-    print(
-        f"Last poll for store: {last_day_ts.strftime(timestamp_format)}, weekday:",
-        last_day_ts.weekday(),
+
+# get the minute of the week (0 is Monday 00:00) of a local time in seconds
+# since the unix epoch, which was a Thursday, i.e. weekday 3
+def get_minute_of_week(local_epoch: int) -> int:
+    return (local_epoch // 60 + 3 * minutes_in_day) % minutes_in_week
+
+
+# load a timezone by name (cached, pytz reads the zoneinfo files on every call)
+_load_tz = lru_cache(maxsize=512)(pytz.timezone)
+
+
+# get the UTC offset (in seconds) of a timezone during a slot of time (in
+# offset_slot seconds since the unix epoch), cached, since polls of stores in the
+# same timezone share the slots
+# Assumption: Timezones only change their offset at the start of a slot
+@lru_cache(maxsize=65536)
+def get_utc_offset(timezone: str, slot: int) -> int:
+    offset = datetime.fromtimestamp(slot * offset_slot, _load_tz(timezone)).utcoffset()
+    # always set, the datetime is aware
+    assert offset is not None
+    return int(offset.total_seconds())
+
+
+# convert seconds since the unix epoch (UTC) to local time in a timezone, also as
+# seconds since the unix epoch
+def get_local_epoch(timezone: str, ts_epoch: int) -> int:
+    return ts_epoch + get_utc_offset(timezone, ts_epoch // offset_slot)
+
+
+# get the polls of many stores in the last week, latest first
+def get_stores_polls(store_ids: List[str]) -> Dict[str, List[PollType]]:
+    # local time of every store's last poll, to anchor the window of polls to fetch
+    last_polls = (
+        select(
+            StoreStatus.store_id,
+            func.max(StoreStatus.local_epoch).label("local_epoch"),
+        )
+        .where(StoreStatus.store_id.in_(store_ids))
+        .group_by(StoreStatus.store_id)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(StoreStatus.store_id, StoreStatus.local_epoch, StoreStatus.status)
+        .join(last_polls, StoreStatus.store_id == last_polls.c.store_id)
+        .where(
+            StoreStatus.local_epoch
+            >= last_polls.c.local_epoch - int(status_window.total_seconds())
+        )
+        .order_by(StoreStatus.store_id, desc(StoreStatus.local_epoch))
     )
 
-    # get the store's business hours for this weekday
-    business_hours = get_store_time(store_id, last_day_ts.weekday())
-    print("Store's business hours on this weekday:")
+    return {
+        store_id: [(local_epoch, status) for _, local_epoch, status in polls]
+        for store_id, polls in groupby(rows, key=itemgetter(0))
+    }
 
-    for hours in business_hours:
-        print(hours[0].strftime(time_format), "to", hours[1].strftime(time_format))
+
+# get the rolled up up and down times of many stores, for their last week
+def get_stores_uptime_daily(
+    store_ids: List[str],
+) -> Dict[str, Dict[int, Tuple[int, int]]]:
+    # every store's last rolled up day, to anchor the week to fetch
+    last_days = (
+        select(StoreUptimeDaily.store_id, func.max(StoreUptimeDaily.day).label("day"))
+        .where(StoreUptimeDaily.store_id.in_(store_ids))
+        .group_by(StoreUptimeDaily.store_id)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(
+            StoreUptimeDaily.store_id,
+            StoreUptimeDaily.day,
+            StoreUptimeDaily.up_hours,
+            StoreUptimeDaily.down_hours,
+        )
+        .join(last_days, StoreUptimeDaily.store_id == last_days.c.store_id)
+        .where(StoreUptimeDaily.day > last_days.c.day - 7)
+        .order_by(StoreUptimeDaily.store_id)
+    )
 
     return {
-        "business_hours": business_hours,
-        "last_day_ts": last_day_ts,
-        "store_status": store_status,
-        "local_tz": local_tz,
+        store_id: {day: (up_hours, down_hours) for _, day, up_hours, down_hours in days}
+        for store_id, days in groupby(rows, key=itemgetter(0))
     }
 
 
@@ -155,9 +423,61 @@ class AllTimes(TypedDict):
     down_hourly: int  # in minutes
 
 
-# get up and down times for a store
-def get_times(store_id: str) -> AllTimes:
-    print(f"\nCalculating uptime for store with id {store_id}")
+# count the up and down times of a store from its polls in local time (seconds
+# since the unix epoch, latest first), in a single pass over plain integers
+def _accumulate(
+    local_epochs: List[int],
+    is_active: List[int],
+    hours_bitmap: bytes,
+    last_day: int,
+    week_start: int,
+) -> Tuple[int, int, int, int, int, int]:
+    up_hourly = down_hourly = up_daily = down_daily = up_weekly = down_weekly = 0
+    did_hit_last_hour = False
+
+    for local_epoch, active in zip(local_epochs, is_active):
+        day = local_epoch // seconds_in_day
+        # if hit all three time intervals, done for this store
+        if day < week_start and did_hit_last_hour:
+            break
+
+        # if the poll was made outside the business hours of the store, ignore it
+        # (same as get_minute_of_week, inlined since this runs for every poll)
+        minute = (local_epoch // 60 + 3 * minutes_in_day) % minutes_in_week
+        if not hours_bitmap[minute >> 3] >> (minute & 7) & 1:
+            continue
+
+        # Assumption: Polls are made every hour, so taking every poll as one whole hour
+        # the last hour is the last poll made within the business hours
+        if not did_hit_last_hour:
+            did_hit_last_hour = True
+            if active:
+                up_hourly = 60  # in minutes
+            else:
+                down_hourly = 60  # in minutes
+
+        if day < week_start:
+            continue
+        if active:
+            up_weekly += 1
+            if day == last_day:
+                up_daily += 1
+        else:
+            down_weekly += 1
+            if day == last_day:
+                down_daily += 1
+
+    return up_hourly, down_hourly, up_daily, down_daily, up_weekly, down_weekly
+
+
+# get up and down times for a store from its polls (latest first)
+def count_times(
+    store_id: str,
+    polls: List[PollType],
+    store_hours: StoreHoursType,
+    uptime_daily: Union[Dict[int, Tuple[int, int]], None] = None,
+) -> AllTimes:
+    logger.debug("Calculating uptime for store with id %s", store_id)
 
     times: AllTimes = {
         "up_weekly": 0,  # in hours
@@ -167,134 +487,436 @@ def get_times(store_id: str) -> AllTimes:
         "up_hourly": 0,  # in minutes
         "down_hourly": 0,  # in minutes
     }
-    # get initial variables for this store
-    initial_vars = get_initial_vars(store_id)
     # if no polls are available for a store, return
-    if initial_vars is None:
+    if not polls:
         return times
 
-    store_status = initial_vars["store_status"]
-    local_tz = initial_vars["local_tz"]
-    last_day_ts = initial_vars["last_day_ts"]
-    business_hours = initial_vars["business_hours"]
-
-    last_day_date = last_day_ts.date()
-    prev_day = last_day_date.day
-    did_hit_last_hour = False
-    did_hit_last_day = False
-    did_hit_last_week = False
-
-    print("Beginning uptime count")
-    for status in store_status:
-        status_dt = status.timestamp.astimezone(local_tz)
-        print(
-            f"Current poll: {status_dt.strftime(timestamp_format)}, status:",
-            status.status,
+    # first entry is the last day, last time in local time
+    # local date of the last poll, as days since the unix epoch
+    last_day = polls[0][0] // seconds_in_day
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Last poll for store (local time): %s, weekday: %s",
+            datetime(1970, 1, 1) + timedelta(seconds=polls[0][0]),
+            # the unix epoch was a Thursday, i.e. weekday 3
+            (last_day + 3) % 7,
         )
 
-        if not did_hit_last_day and status_dt.date() != last_day_date:
-            # passed the last day if the code reached here
-            print("Passed last day")
-            did_hit_last_day = True
+    # if the days before the last day are rolled up, take them from the rollup
+    # and only count the last day from the polls
+    week_start = last_day - 6
+    if uptime_daily and last_day - 1 in uptime_daily:
+        for day in range(week_start, last_day):
+            up_hours, down_hours = uptime_daily.get(day, (0, 0))
+            times["up_weekly"] += up_hours
+            times["down_weekly"] += down_hours
+        week_start = last_day
+
+    (
+        times["up_hourly"],
+        times["down_hourly"],
+        times["up_daily"],
+        times["down_daily"],
+        up_weekly,
+        down_weekly,
+    ) = _accumulate(
+        [local_epoch for local_epoch, _ in polls],
+        [status for _, status in polls],
+        get_hours_bitmap(store_hours),
+        last_day,
+        week_start,
+    )
+    times["up_weekly"] += up_weekly
+    times["down_weekly"] += down_weekly
 
-        if not did_hit_last_week and (
-            status_dt.date() != last_day_date
-            and status_dt.weekday() == last_day_ts.weekday()
-        ):
-            # if reached the same weekday on a different date, then completed calculating for an entire week
-            print("Passed last week")
-            did_hit_last_week = True
+    logger.debug("Final values: %s", times)
+    return times
 
-        # if hit all three time intervals, done for this store
-        if did_hit_last_week and did_hit_last_day and did_hit_last_hour:
-            print(f"Done calculating for store with id {store_id}")
-            break
 
-        # if the day has changed, fetch the business hours for the new day
-        if prev_day != status_dt.day:
-            prev_day = status_dt.day
-            business_hours = get_store_time(store_id, status_dt.weekday())
-
-        for hours in business_hours:
-            poll_time = status_dt.time()
-            # if the poll was made outside the business hours of the store, ignore it
-            # less than the start_time or greater than the end_time
-            if poll_time < hours[0].time() or poll_time > hours[1].time():
-                continue
-
-            # Assumption: Polls are made every hour, so taking every poll as one whole hour
-            if status.status == "active":
-                print("Adding to uptime")
-
-                if not did_hit_last_hour:
-                    times["up_hourly"] += 60  # in minutes
-                if not did_hit_last_day:
-                    times["up_daily"] += 1
-                if not did_hit_last_week:
-                    times["up_weekly"] += 1
-            else:
-                print("Adding to downtime")
+# fingerprint of the data reports are generated from, reports with the same
+# fingerprint have the same contents. The tables are only appended to, so their
+# highest ids (rowid lookups, unlike the max of an unindexed column) tell loads apart
+def get_data_fingerprint() -> str:
+    store_count = db.session.execute(select(func.count(Timezone.id))).scalar()
+    max_status_id = db.session.execute(select(func.max(StoreStatus.id))).scalar()
+    max_hours_id = db.session.execute(select(func.max(StoreHours.id))).scalar()
 
-                if not did_hit_last_hour:
-                    times["down_hourly"] += 60  # in minutes
-                if not did_hit_last_day:
-                    times["down_daily"] += 1
-                if not did_hit_last_week:
-                    times["down_weekly"] += 1
+    return hashlib.blake2b(
+        f"{store_count}:{max_status_id}:{max_hours_id}".encode()
+    ).hexdigest()
 
-            # if reached here then the last hour has been hit
-            if not did_hit_last_hour:
-                print("Passed last hour")
-                did_hit_last_hour = True
 
-    print("Final values:", times, "\n")
-    return times
+# path of a report's (gzipped) csv file
+def get_report_path(report_id: str) -> str:
+    return f"./reports/{report_id}.csv.gz"
 
 
-# generate the csv file
-def generate_report(report_id: str):
+# get the ids of the stores included in reports
+def get_report_store_ids() -> List[str]:
+    return list(
+        db.session.execute(
+            select(Timezone.store_id).order_by(Timezone.store_id).limit(100)
+        ).scalars()
+    )
+
+
+# count the times of many stores, in the order of the stores
+def count_stores_times(store_ids: List[str]) -> Iterator[AllTimes]:
+    # fetch the data of all the stores at once, instead of querying per store
+    all_store_hours = get_stores_hours(store_ids)
+    all_store_polls = get_stores_polls(store_ids)
+    all_store_uptime_daily = get_stores_uptime_daily(store_ids)
+
+    # counted serially: a report has at most 100 stores, which take a few
+    # milliseconds in total, while starting a process pool takes tens of milliseconds
+    # (and forking a multithreaded server process isn't safe)
+    for store_id in store_ids:
+        yield count_times(
+            store_id,
+            all_store_polls.get(store_id, []),
+            all_store_hours.get(store_id, {}),
+            all_store_uptime_daily.get(store_id),
+        )
+
+
+# precompute the times of every store into the store report table, so that
+# reports on the same data only have to read them
+def compute_store_reports():
     with app.app_context():
         st = time.time()
-        all_stores: List[Timezone] = (
-            Timezone.query.order_by("store_id").limit(100).all()
+        fingerprint = get_data_fingerprint()
+        store_ids = get_report_store_ids()
+        # counted before the table is written to, so that the write lock is only
+        # held for the inserts
+        rows = [
+            {"store_id": store_id, **times, "fingerprint": fingerprint}
+            for store_id, times in zip(store_ids, count_stores_times(store_ids))
+        ]
+
+        db.session.execute(delete(StoreReport))
+        insert_in_batches(StoreReport, rows)
+        db.session.commit()
+
+        logger.info("Time taken to compute store reports: %s", time.time() - st)
+
+
+# write the csv file
+def write_report(report_path: str, fingerprint: str):
+    # use the precomputed times if they were computed from the same data
+    rows: Iterable[Sequence[Any]] = db.session.execute(
+        select(
+            StoreReport.store_id,
+            StoreReport.up_hourly,
+            StoreReport.up_daily,
+            StoreReport.up_weekly,
+            StoreReport.down_hourly,
+            StoreReport.down_daily,
+            StoreReport.down_weekly,
+        )
+        .where(StoreReport.fingerprint == fingerprint)
+        .order_by(StoreReport.store_id)
+    ).all()
+    if not rows:
+        store_ids = get_report_store_ids()
+        rows = (
+            [
+                store_id,
+                times["up_hourly"],
+                times["up_daily"],
+                times["up_weekly"],
+                times["down_hourly"],
+                times["down_daily"],
+                times["down_weekly"],
+            ]
+            for store_id, times in zip(store_ids, count_stores_times(store_ids))
         )
 
-        with open(f"./reports/{report_id}.csv", "w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(
-                [
-                    "store_id",
-                    "uptime_last_hour(in minutes)",
-                    "uptime_last_day(in hours)",
-                    "uptime_last_week(in hours)",
-                    "downtime_last_hour(in minutes)",
-                    "downtime_last_day(in hours)",
-                    "downtime_last_week(in hours)",
-                ]
-            )
+    # reports are compressed as they are written, gzip level 1 costs little cpu
+    with gzip.open(report_path, "wt", newline="", compresslevel=1) as file:
+        writer = csv.writer(file)
+        writer.writerow(
+            [
+                "store_id",
+                "uptime_last_hour(in minutes)",
+                "uptime_last_day(in hours)",
+                "uptime_last_week(in hours)",
+                "downtime_last_hour(in minutes)",
+                "downtime_last_day(in hours)",
+                "downtime_last_week(in hours)",
+            ]
+        )
+        writer.writerows(rows)
 
-            for store in all_stores:
-                times = get_times(store.store_id)
-                writer.writerow(
-                    [
-                        store.store_id,
-                        times["up_hourly"],
-                        times["up_daily"],
-                        times["up_weekly"],
-                        times["down_hourly"],
-                        times["down_daily"],
-                        times["down_weekly"],
-                    ]
-                )
+
+# generate the csv file
+def generate_report(report_id: str):
+    with app.app_context():
+        st = time.time()
+        report_path = get_report_path(report_id)
+        report: Report = Report.query.filter(Report.report_id == report_id).first()
+        report.fingerprint = get_data_fingerprint()
+
+        # if a report was already generated from the same data, reuse its file
+        cached_report_id: Union[str, None] = db.session.execute(
+            select(Report.report_id)
+            .where(
+                (Report.fingerprint == report.fingerprint)
+                & (Report.status == "Completed")
+            )
+            .limit(1)
+        ).scalar()
+        if cached_report_id is not None and os.path.exists(
+            get_report_path(cached_report_id)
+        ):
+            logger.info("Reusing report %s", cached_report_id)
+            shutil.copyfile(get_report_path(cached_report_id), report_path)
+        else:
+            write_report(report_path, report.fingerprint)
 
         time_taken = (time.time() - st) / 60  # in minutes
 
-        report: Report = Report.query.filter(Report.report_id == report_id).first()
         report.status = "Completed"
         report.time_taken = time_taken
         db.session.commit()
 
-        print("\nTime taken:", time_taken)
+        logger.info("Time taken to generate report %s: %s", report_id, time_taken)
+
+
+# roll up the up and down times of every store per local day, starting after
+# the last rolled up day (the current day is left out, since it isn't over yet)
+def rollup_uptime():
+    all_stores = db.session.execute(select(Timezone.store_id)).all()
+
+    for store in all_stores:
+        hours_bitmap = get_hours_bitmap(get_all_store_hours(store.store_id))
+        last_rolled_day: Union[int, None] = db.session.execute(
+            select(func.max(StoreUptimeDaily.day)).where(
+                StoreUptimeDaily.store_id == store.store_id
+            )
+        ).scalar()
+
+        polls_query = select(StoreStatus.local_epoch, StoreStatus.status).where(
+            StoreStatus.store_id == store.store_id
+        )
+        if last_rolled_day is not None:
+            polls_query = polls_query.where(
+                StoreStatus.local_epoch >= (last_rolled_day + 1) * seconds_in_day
+            )
+        # the polls are streamed in batches, since the first rollup of a store
+        # reads its whole history
+        polls = db.session.execute(
+            polls_query.order_by(StoreStatus.local_epoch),
+            execution_options={"yield_per": 10000},
+        )
+
+        # up and down hours of every local day
+        days: Dict[int, List[int]] = {}
+        for local_epoch, status in polls:
+            day = local_epoch // seconds_in_day
+            counts = days.setdefault(day, [0, 0])
+            minute = get_minute_of_week(local_epoch)
+            if hours_bitmap[minute >> 3] >> (minute & 7) & 1:
+                counts[0 if status else 1] += 1
+        if not days:
+            continue
+
+        # every day is rolled up (even without polls), so that a missing day
+        # means the rollup isn't up to date
+        first_day = min(days) if last_rolled_day is None else last_rolled_day + 1
+        for day in range(first_day, max(days)):
+            up_hours, down_hours = days.get(day, (0, 0))
+            db.session.add(
+                StoreUptimeDaily(
+                    store_id=store.store_id,
+                    day=day,
+                    up_hours=up_hours,
+                    down_hours=down_hours,
+                )
+            )
+
+    db.session.commit()
+
+
+# the default value of a column, for a row that doesn't give it (None if the
+# column has no python side default)
+def get_column_default(column: Column) -> Any:
+    default = column.default
+    if isinstance(default, ColumnDefault) and default.is_callable:
+        return default.arg(None)
+    if isinstance(default, ColumnDefault) and default.is_scalar:
+        return default.arg
+
+    return None
+
+
+# the values of a batch of rows, in the order of the columns, as a flat sequence
+# of parameters converted by the columns' bind processors
+def get_batch_parameters(
+    batch: List[Dict[str, Any]], columns: List[Column], processors: List[Any]
+) -> Iterator[Any]:
+    for row in batch:
+        for column, processor in zip(columns, processors):
+            if column.name in row:
+                value = row[column.name]
+            else:
+                value = get_column_default(column)
+            yield value if processor is None else processor(value)
+
+
+# insert rows into a model's table in batches, so that only one batch of rows
+# is held in memory at a time. With SQLite, every batch is a single multi-row
+# INSERT sent straight to the driver (the values are converted by the column
+# types, and missing values are filled in from the column defaults, as
+# sqlalchemy would), other databases get an executemany per batch. So do tables
+# with SQL expression defaults, which can't be sent as parameters
+def insert_in_batches(model, rows: Iterable[Dict[str, Any]], batch_size=500):
+    table = model.__table__
+    dialect = db.engine.dialect
+    rows = iter(rows)
+    if dialect.name != "sqlite" or any(
+        isinstance(column.default, ColumnDefault) and column.default.is_clause_element
+        for column in table.c
+    ):
+        while batch := list(islice(rows, batch_size)):
+            db.session.execute(table.insert(), batch)
+        return
+
+    # sqlite limits the number of parameters of a statement (999 before 3.32)
+    max_parameters = 32766 if sqlite3.sqlite_version_info >= (3, 32) else 999
+    batch_size = min(batch_size, max_parameters // len(table.c))
+    preparer = dialect.identifier_preparer
+    connection = db.session.connection()
+    while batch := list(islice(rows, batch_size)):
+        # the columns given in any row of the batch, and the ones with a default
+        given = set().union(*batch)
+        columns = [
+            column
+            for column in table.c
+            if column.name in given or isinstance(column.default, ColumnDefault)
+        ]
+        processors = [
+            column.type.dialect_impl(dialect).bind_processor(dialect)
+            for column in columns
+        ]
+        names = ", ".join(preparer.quote(column.name) for column in columns)
+        row_values = f"({', '.join('?' * len(columns))})"
+        connection.exec_driver_sql(
+            f"INSERT INTO {preparer.format_table(table)} ({names}) VALUES "
+            + ", ".join([row_values] * len(batch)),
+            tuple(get_batch_parameters(batch, columns, processors)),
+        )
+
+
+# read the timezones of a csv file as timezone rows, keeping the first timezone
+# of every store (a store can be repeated in the file, or already be loaded)
+def read_timezones(timezone_file: TextIO) -> Iterator[Dict[str, Any]]:
+    store_ids = set(db.session.execute(select(Timezone.store_id)).scalars())
+    reader = csv.reader(timezone_file)
+    next(reader, None)  # skip the header
+
+    for line in reader:
+        if line[0] in store_ids:
+            continue
+
+        store_ids.add(line[0])
+        yield {"store_id": line[0], "timezone": line[1] or default_timezone}
+
+
+# load the polls of a csv file into the store status table, doing the work in
+# SQLite: the rows are copied into a staging table as they are (by the driver,
+# without a python object per column), then parsed and inserted with an
+# INSERT ... SELECT, which calls get_local_epoch as an SQL function. This is done
+# in chunks of rows, so that the staging table (in memory) doesn't grow with the file
+def load_store_status_sqlite(file_path: str, chunk_size=50000):
+    dbapi_connection = db.session.connection().connection.dbapi_connection
+    # only None once the connection is closed or invalidated
+    assert dbapi_connection is not None
+    dbapi_connection.create_function(
+        "get_local_epoch", 2, get_local_epoch, deterministic=True
+    )
+    dbapi_connection.execute(
+        "CREATE TEMP TABLE store_status_csv (store_id, status, timestamp_utc)"
+    )
+
+    insert_from_staging = """
+        INSERT INTO store_status
+            (store_id, status, timestamp, ts_epoch, local_epoch)
+        SELECT
+            store_id, status, timestamp, ts_epoch,
+            get_local_epoch(coalesce(timezone, ?), ts_epoch)
+        FROM (
+            SELECT
+                store_status_csv.store_id,
+                store_status_csv.status = 'active' AS status,
+                -- 2023-01-25 11:09:27.334577 UTC, in the format sqlalchemy
+                -- stores datetimes in (microseconds padded to 6 digits)
+                substr(timestamp_utc, 1, 19) || '.' || substr(
+                    substr(
+                        timestamp_utc, 21, max(length(timestamp_utc) - 24, 0)
+                    ) || '000000', 1, 6
+                ) AS timestamp,
+                CAST(
+                    strftime('%s', substr(timestamp_utc, 1, 19)) AS INTEGER
+                ) AS ts_epoch,
+                timezone.timezone
+            FROM store_status_csv
+            LEFT JOIN timezone
+                ON timezone.store_id = store_status_csv.store_id
+        )
+        """
+
+    try:
+        with open(file_path, mode="r") as store_status_file:
+            reader = csv.reader(store_status_file)
+            next(reader, None)  # skip the header
+
+            while chunk := list(islice(reader, chunk_size)):
+                dbapi_connection.executemany(
+                    "INSERT INTO store_status_csv VALUES (?, ?, ?)", chunk
+                )
+                dbapi_connection.execute(insert_from_staging, (default_timezone,))
+                dbapi_connection.execute("DELETE FROM store_status_csv")
+    finally:
+        dbapi_connection.execute("DROP TABLE store_status_csv")
+
+
+# drop the indexes of a model's table while rows are bulk loaded into it, and
+# build them once afterwards (a single sort, instead of updating them per row)
+@contextmanager
+def without_indexes(model):
+    connection = db.session.connection()
+    indexes = model.__table__.indexes
+    for index in indexes:
+        index.drop(connection, checkfirst=True)
+
+    try:
+        yield
+    finally:
+        for index in indexes:
+            index.create(connection, checkfirst=True)
+
+
+# run a bulk load as a single transaction, committed at the end. SQLite skips
+# syncing to disk during the load, since an interrupted load is redone from the
+# csv files anyway
+@contextmanager
+def bulk_load():
+    pool_connection = db.session.connection().connection
+    dbapi_connection = pool_connection.dbapi_connection
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute("PRAGMA synchronous=OFF")
+        # set back by restore_sqlite_synchronous once the connection is returned
+        pool_connection.info["synchronous_off"] = True
+        # the driver only begins a transaction before inserts, so dropping the
+        # indexes would otherwise be committed even if the load fails
+        dbapi_connection.execute("BEGIN")
+
+    try:
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
 
 
 ## ROUTES
@@ -307,37 +929,46 @@ def index_route():
 # add csv data to db (temporary route)
 @app.route("/add_data_to_db")
 def add_data_to_db():
-    with open("store_hours.csv", mode="r") as store_hours_file:
-        file = list(csv.reader(store_hours_file))[1:]
-
-        for line in file:
-            store = StoreHours(
-                store_id=line[0],
-                day_of_week=line[1],
-                start_time=get_datetime_from_ts(line[2], True),
-                end_time=get_datetime_from_ts(line[3], True),
-            )
-            db.session.add(store)
+    # rows are streamed from the files and inserted in bulk, without building an
+    # ORM object for every row
+    with bulk_load():
+        with without_indexes(StoreHours):
+            with open("store_hours.csv", mode="r") as store_hours_file:
+                reader = csv.reader(store_hours_file)
+                next(reader, None)  # skip the header
+
+                insert_in_batches(
+                    StoreHours,
+                    (
+                        {
+                            "store_id": line[0],
+                            "day_of_week": int(line[1]),
+                            "start_time": get_datetime_from_ts(line[2], True),
+                            "end_time": get_datetime_from_ts(line[3], True),
+                        }
+                        for line in reader
+                    ),
+                )
 
-    with open("store_status.csv", mode="r") as store_status_file:
-        file = list(csv.reader(store_status_file))[1:]
+        with without_indexes(Timezone):
+            with open("timezone.csv", mode="r") as timezone_file:
+                insert_in_batches(Timezone, read_timezones(timezone_file))
 
-        for line in file:
-            store = StoreStatus(
-                store_id=line[0],
-                status=line[1],
-                timestamp=get_datetime_from_ts(line[2]),
-            )
-            db.session.add(store)
+        # the file is parsed and inserted by SQLite itself, the local time of the
+        # polls is computed with the timezones loaded above
+        with without_indexes(StoreStatus):
+            load_store_status_sqlite("store_status.csv")
 
-    with open("timezone.csv", mode="r") as timezone_file:
-        file = list(csv.reader(timezone_file))[1:]
+        # the rolled up days no longer match the polls and business hours (new
+        # polls can fall on rolled up days), reports count the polls until the next
+        # rollup-uptime run rolls them up again
+        db.session.execute(delete(StoreUptimeDaily))
 
-        for line in file:
-            store = Timezone(store_id=line[0], timezone=line[1] or "America/Chicago")
-            db.session.add(store)
+    # the cached business hours are stale now
+    get_hours_of_all_stores.cache_clear()
 
-    db.session.commit()
+    # precompute the report times of the new data in the background
+    Thread(target=compute_store_reports).start()
 
     return "Done"
 
@@ -360,12 +991,60 @@ def trigger_report():
 
 @app.route("/get_report/<report_id>")
 def get_report(report_id: str):
-    report: Report = Report.query.filter(Report.report_id == report_id).first()
+    # only the status is needed, not the whole report row
+    status: Union[str, None] = db.session.execute(
+        select(Report.status).where(Report.report_id == report_id)
+    ).scalar()
 
-    if report.status == "Running":
+    if status == "Running":
         return jsonify({"status": "Running"})
 
-    return send_file(f"./reports/{report_id}.csv")
+    # reports generated before they were gzipped are sent as they are
+    report_path = get_report_path(report_id)
+    legacy_report_path = f"./reports/{report_id}.csv"
+    if not os.path.exists(report_path) and os.path.exists(legacy_report_path):
+        return send_file(
+            legacy_report_path, mimetype="text/csv", download_name=f"{report_id}.csv"
+        )
+
+    # clients that don't accept gzip get the file decompressed as it is sent (by
+    # flask, even behind nginx, which would send it compressed)
+    accel_redirect = app.config["REPORTS_ACCEL_REDIRECT"]
+    if not request.accept_encodings["gzip"]:
+        # (a GzipFile is a binary file, though it isn't typed as IO[bytes])
+        response = send_file(
+            cast(IO[bytes], gzip.open(report_path, "rb")),
+            mimetype="text/csv",
+            download_name=f"{report_id}.csv",
+        )
+    # let nginx send the file if the app is behind it (the headers nginx passes on
+    # with the file are set here, Content-Encoding is set by the nginx location)
+    elif accel_redirect:
+        response = Response(
+            mimetype="text/csv",
+            headers={
+                "X-Accel-Redirect": f"{accel_redirect}{report_id}.csv.gz",
+                "Content-Disposition": f"inline; filename={report_id}.csv",
+                "Content-Encoding": "gzip",
+            },
+        )
+    # otherwise the file is sent as is, clients decompress it
+    else:
+        response = send_file(
+            report_path, mimetype="text/csv", download_name=f"{report_id}.csv"
+        )
+        response.headers["Content-Encoding"] = "gzip"
+
+    # the response depends on the client's Accept-Encoding, for caches
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+## COMMANDS
+# roll up the polls per day, to be run nightly (flask --app app rollup-uptime)
+@app.cli.command("rollup-uptime")
+def rollup_uptime_command():
+    rollup_uptime()
 
 
 ## RUN